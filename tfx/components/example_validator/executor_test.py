@@ -13,8 +13,11 @@
 # limitations under the License.
 """Tests for tfx.components.example_validator.executor."""
 
+import concurrent.futures
+import copy
 import os
 import tempfile
+from typing import Optional
 
 from absl.testing import parameterized
 from tensorflow_data_validation.anomalies.proto import custom_validation_config_pb2
@@ -31,54 +34,130 @@ from google.protobuf import text_format
 from tensorflow_metadata.proto.v0 import anomalies_pb2
 
 
-_ANOMALIES_PROTO = text_format.Parse(
+# Binary serialization of the following text-format `Anomalies` proto, so
+# that importing the test does not pay for text-format parsing:
+#
+# anomaly_info {
+#   key: 'company'
+#   value {
+#     path {
+#       step: 'company'
+#     }
+#     severity: ERROR
+#     short_description: 'Feature does not have enough values.'
+#     description: 'Custom validation triggered anomaly. Query: feature.string_stats.common_stats.min_num_values > 5 Test dataset: default slice'
+#     reason {
+#       description: 'Custom validation triggered anomaly. Query: feature.string_stats.common_stats.min_num_values > 5 Test dataset: default slice'
+#       type: CUSTOM_VALIDATION
+#       short_description: 'Feature does not have enough values.'
+#     }
+#   }
+# }
+# dataset_anomaly_info {
+#   description: "Low num examples in dataset."
+#   severity: ERROR
+#   short_description: "Low num examples in dataset."
+#   reason {
+#       type: DATASET_LOW_NUM_EXAMPLES
+#   }
+# }
+_ANOMALIES_BYTES = (
+    b'\x12\xe6\x02\n\x07company\x12\xda\x02\x12|Custom validation triggere'
+    b'd anomaly. Query: feature.string_stats.common_stats.min_num_values >'
+    b' 5 Test dataset: default slice(\x022$Feature does not have enough va'
+    b'lues.:\xa6\x01\x08V\x12$Feature does not have enough values.\x1a|Cus'
+    b'tom validation triggered anomaly. Query: feature.string_stats.common'
+    b'_stats.min_num_values > 5 Test dataset: default sliceB\t\n\x07compan'
+    b'yBB\x12\x1cLow num examples in dataset.(\x022\x1cLow num examples in'
+    b' dataset.:\x02\x083'
+)
+_ANOMALIES_PROTO = anomalies_pb2.Anomalies()
+_ANOMALIES_PROTO.ParseFromString(_ANOMALIES_BYTES)
+
+# List needs to be serialized before being passed into Do function.
+_EXCLUDE_SPLITS_JSON = json_utils.dumps(['test'])
+
+
+class ExecutorTest(parameterized.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    super().setUpClass()
+    cls._source_data_dir = os.path.join(
+        os.path.dirname(os.path.dirname(__file__)), 'testdata')
+
+    cls._eval_stats_artifact = standard_artifacts.ExampleStatistics()
+    cls._eval_stats_artifact.uri = os.path.join(cls._source_data_dir,
+                                                'statistics_gen')
+    cls._eval_stats_artifact.split_names = artifact_utils.encode_split_names(
+        ['train', 'eval', 'test'])
+    cls._eval_stats_artifact.span = 11
+
+    cls._schema_artifact = standard_artifacts.Schema()
+    cls._schema_artifact.uri = os.path.join(cls._source_data_dir, 'schema_gen')
+
+  @classmethod
+  def _run_executor(cls, custom_validation_config: Optional[str]):
+    """Runs the executor with the given custom validation config.
+
+    Args:
+      custom_validation_config: Text-format `CustomValidationConfig`, or None.
+
+    Returns:
+      A tuple of the input statistics artifact, the output anomalies artifact
+      and the `ExecutorOutput` returned by `Do`.
     """
-    anomaly_info {
-      key: 'company'
-      value {
-        path {
-          step: 'company'
-        }
-        severity: ERROR
-        short_description: 'Feature does not have enough values.'
-        description: 'Custom validation triggered anomaly. Query: feature.string_stats.common_stats.min_num_values > 5 Test dataset: default slice'
-        reason {
-          description: 'Custom validation triggered anomaly. Query: feature.string_stats.common_stats.min_num_values > 5 Test dataset: default slice'
-          type: CUSTOM_VALIDATION
-          short_description: 'Feature does not have enough values.'
-        }
-      }
+    # Artifacts are built once per class; copy them so that the executor
+    # cannot leak state from one run into another.
+    eval_stats_artifact = copy.deepcopy(cls._eval_stats_artifact)
+    schema_artifact = copy.deepcopy(cls._schema_artifact)
+
+    output_data_dir = tempfile.mkdtemp(
+        dir=os.environ.get('TEST_UNDECLARED_OUTPUTS_DIR'))
+
+    validation_output = standard_artifacts.ExampleAnomalies()
+    validation_output.uri = os.path.join(output_data_dir, 'output')
+
+    input_dict = {
+        standard_component_specs.STATISTICS_KEY: [eval_stats_artifact],
+        standard_component_specs.SCHEMA_KEY: [schema_artifact],
     }
-    dataset_anomaly_info {
-      description: "Low num examples in dataset."
-      severity: ERROR
-      short_description: "Low num examples in dataset."
-      reason {
-          type: DATASET_LOW_NUM_EXAMPLES
-      }
+
+    if custom_validation_config is not None:
+      custom_validation_config = text_format.Parse(
+          custom_validation_config,
+          custom_validation_config_pb2.CustomValidationConfig()
+      )
+    exec_properties = {
+        standard_component_specs.EXCLUDE_SPLITS_KEY: _EXCLUDE_SPLITS_JSON,
+        standard_component_specs.CUSTOM_VALIDATION_CONFIG_KEY:
+            custom_validation_config,
     }
-    """,
-    anomalies_pb2.Anomalies()
-)
 
+    output_dict = {
+        standard_component_specs.ANOMALIES_KEY: [validation_output],
+    }
 
-class ExecutorTest(parameterized.TestCase):
+    example_validator_executor = executor.Executor()
+    executor_output = example_validator_executor.Do(
+        input_dict, output_dict, exec_properties
+    )
+    return eval_stats_artifact, validation_output, executor_output
 
-  def _get_temp_dir(self):
-    return tempfile.mkdtemp()
+  def _canonicalize_anomalies(self, anomalies):
+    """Returns deterministic bytes of `anomaly_info` without diff_regions."""
+    canonical_anomalies = anomalies_pb2.Anomalies()
+    for feature_name, anomaly_info in anomalies.anomaly_info.items():
+      canonical_anomalies.anomaly_info[feature_name].CopyFrom(anomaly_info)
+      # Do not compare diff_regions.
+      canonical_anomalies.anomaly_info[feature_name].ClearField('diff_regions')
+    return canonical_anomalies.SerializeToString(deterministic=True)
 
   def _assert_equal_anomalies(self, actual_anomalies, expected_anomalies):
     # Check if the actual anomalies matches with the expected anomalies.
-    for feature_name in expected_anomalies.anomaly_info:
-      self.assertIn(feature_name, actual_anomalies.anomaly_info)
-      # Do not compare diff_regions.
-      actual_anomalies.anomaly_info[feature_name].ClearField('diff_regions')
-
-      self.assertEqual(actual_anomalies.anomaly_info[feature_name],
-                       expected_anomalies.anomaly_info[feature_name])
     self.assertEqual(
-        len(actual_anomalies.anomaly_info),
-        len(expected_anomalies.anomaly_info)
+        self._canonicalize_anomalies(actual_anomalies),
+        self._canonicalize_anomalies(expected_anomalies),
     )
 
   @parameterized.named_parameters(
@@ -116,50 +195,8 @@ class ExecutorTest(parameterized.TestCase):
       expected_anomalies,
       expected_blessing,
   ):
-    source_data_dir = os.path.join(
-        os.path.dirname(os.path.dirname(__file__)), 'testdata')
-
-    eval_stats_artifact = standard_artifacts.ExampleStatistics()
-    eval_stats_artifact.uri = os.path.join(source_data_dir, 'statistics_gen')
-    eval_stats_artifact.split_names = artifact_utils.encode_split_names(
-        ['train', 'eval', 'test'])
-    eval_stats_artifact.span = 11
-
-    schema_artifact = standard_artifacts.Schema()
-    schema_artifact.uri = os.path.join(source_data_dir, 'schema_gen')
-
-    output_data_dir = os.path.join(
-        os.environ.get('TEST_UNDECLARED_OUTPUTS_DIR', self._get_temp_dir()),
-        self._testMethodName)
-
-    validation_output = standard_artifacts.ExampleAnomalies()
-    validation_output.uri = os.path.join(output_data_dir, 'output')
-
-    input_dict = {
-        standard_component_specs.STATISTICS_KEY: [eval_stats_artifact],
-        standard_component_specs.SCHEMA_KEY: [schema_artifact],
-    }
-
-    if custom_validation_config is not None:
-      custom_validation_config = text_format.Parse(
-          custom_validation_config,
-          custom_validation_config_pb2.CustomValidationConfig()
-      )
-    exec_properties = {
-        # List needs to be serialized before being passed into Do function.
-        standard_component_specs.EXCLUDE_SPLITS_KEY:
-            json_utils.dumps(['test']),
-        standard_component_specs.CUSTOM_VALIDATION_CONFIG_KEY:
-            custom_validation_config,
-    }
-
-    output_dict = {
-        standard_component_specs.ANOMALIES_KEY: [validation_output],
-    }
-
-    example_validator_executor = executor.Executor()
-    executor_output = example_validator_executor.Do(
-        input_dict, output_dict, exec_properties
+    eval_stats_artifact, validation_output, executor_output = (
+        self._run_executor(custom_validation_config)
     )
 
     self.assertEqual(
@@ -172,22 +209,27 @@ class ExecutorTest(parameterized.TestCase):
                                         'SchemaDiff.pb')
     eval_anomalies_path = os.path.join(validation_output.uri, 'Split-eval',
                                        'SchemaDiff.pb')
-    self.assertTrue(fileio.exists(train_anomalies_path))
-    self.assertTrue(fileio.exists(eval_anomalies_path))
-    train_anomalies_bytes = io_utils.read_bytes_file(train_anomalies_path)
-    train_anomalies = anomalies_pb2.Anomalies()
-    train_anomalies.ParseFromString(train_anomalies_bytes)
-    eval_anomalies_bytes = io_utils.read_bytes_file(eval_anomalies_path)
-    eval_anomalies = anomalies_pb2.Anomalies()
-    eval_anomalies.ParseFromString(eval_anomalies_bytes)
-
-    self._assert_equal_anomalies(train_anomalies, expected_anomalies)
-    self._assert_equal_anomalies(eval_anomalies, expected_anomalies)
+    test_anomalies_path = os.path.join(validation_output.uri, 'Split-test',
+                                       'SchemaDiff.pb')
+    # The output files are independent, so check and read them concurrently.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as pool:
+      train_exists, eval_exists, test_exists = pool.map(
+          fileio.exists,
+          [train_anomalies_path, eval_anomalies_path, test_anomalies_path])
+      self.assertTrue(train_exists)
+      self.assertTrue(eval_exists)
+      train_anomalies_bytes, eval_anomalies_bytes = pool.map(
+          io_utils.read_bytes_file, [train_anomalies_path, eval_anomalies_path])
+    # Reuse one message for both splits; each is compared before the next
+    # parse overwrites it.
+    actual_anomalies = anomalies_pb2.Anomalies()
+    for anomalies_bytes in (train_anomalies_bytes, eval_anomalies_bytes):
+      actual_anomalies.Clear()
+      actual_anomalies.ParseFromString(anomalies_bytes)
+      self._assert_equal_anomalies(actual_anomalies, expected_anomalies)
 
     # Assert 'test' split is excluded.
-    train_file_path = os.path.join(validation_output.uri, 'Split-test',
-                                   'SchemaDiff.pb')
-    self.assertFalse(fileio.exists(train_file_path))
+    self.assertFalse(test_exists)
     # TODO(zhitaoli): Add comparison to expected anomolies.
 
     self.assertEqual(
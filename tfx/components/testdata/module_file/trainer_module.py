@@ -17,6 +17,7 @@ The utilities in this file are used to build a model with native Keras.
 This module file will be used in Transform and generic Trainer.
 """
 
+import itertools
 from typing import Optional
 
 from absl import logging
@@ -74,32 +75,85 @@ def _transformed_names(keys):
   return [_transformed_name(key) for key in keys]
 
 
-def _fill_in_missing(x):
-  """Replace missing values in a SparseTensor.
+# Transformed feature keys, computed once at import time.
+_DENSE_FLOAT_XF = _transformed_names(_DENSE_FLOAT_FEATURE_KEYS)
+_VOCAB_XF = _transformed_names(_VOCAB_FEATURE_KEYS)
+_BUCKET_XF = _transformed_names(_BUCKET_FEATURE_KEYS)
+_CATEGORICAL_XF = _transformed_names(_CATEGORICAL_FEATURE_KEYS)
+_LABEL_XF = _transformed_name(_LABEL_KEY)
 
-  Fills in missing values of `x` with '' or 0, and converts to a dense tensor.
+
+def _fill_in_missing(inputs, keys):
+  """Replace missing values in SparseTensors.
+
+  Fills in missing values of each feature with '' or 0, and converts it to a
+  dense tensor. Sparse features of the same dtype are concatenated so that a
+  single SparseToDense op fills in all of them, and are then split back into
+  per-feature tensors.
+
+  Every returned tensor depends on all same-dtype features in `keys`, so TFT
+  treats all of them as analyzer inputs if any one of them feeds an analyzer.
+  Only pass keys that are used the same way, e.g. all feeding analyzers.
 
   Args:
-      x: A `SparseTensor` of rank 2.  Its dense shape should have size at most 1
-      in the second dimension.
+      inputs: map from feature keys to raw not-yet-transformed features. Each
+      sparse feature is a `SparseTensor` of rank 2 whose dense shape should
+      have size at most 1 in the second dimension.
+      keys: keys of the features in `inputs` to fill in.
 
   Returns:
-      A rank 1 tensor where missing values of `x` have been filled in.
+      Map from each key in `keys` to a tensor where missing values have been
+      filled in. Features that are not sparse are returned unchanged.
   """
-  if not isinstance(x, tf.sparse.SparseTensor):
-    return x
+  outputs = {}
+  sparse_keys_by_dtype = {}
+  for key in keys:
+    if isinstance(inputs[key], tf.sparse.SparseTensor):
+      sparse_keys_by_dtype.setdefault(inputs[key].dtype, []).append(key)
+    else:
+      outputs[key] = inputs[key]
+
+  for dtype, dtype_keys in sparse_keys_by_dtype.items():
+    batch_size = inputs[dtype_keys[0]].dense_shape[0]
+    sparse_tensor = tf.sparse.concat(
+        axis=1,
+        sp_inputs=[
+            tf.SparseTensor(
+                inputs[key].indices, inputs[key].values, [batch_size, 1]
+            )
+            for key in dtype_keys
+        ],
+    )
+    # tf.sparse.concat loses the static dense shape; restore it so that every
+    # filled-in feature keeps the static shape [None, 1] that TFT requires.
+    sparse_tensor = tf.SparseTensor(
+        sparse_tensor.indices,
+        sparse_tensor.values,
+        [batch_size, len(dtype_keys)],
+    )
+    default_value = '' if dtype == tf.string else 0
+    dense_tensor = tf.sparse.to_dense(sparse_tensor, default_value)
+    outputs.update(
+        zip(dtype_keys, tf.split(dense_tensor, len(dtype_keys), axis=1))
+    )
+  return outputs
 
-  default_value = '' if x.dtype == tf.string else 0
-  dense_tensor = tf.sparse.to_dense(
-      tf.SparseTensor(x.indices, x.values, [x.dense_shape[0], 1]),
-      default_value,
-  )
-  return dense_tensor
 
+def _get_tf_examples_serving_signature(
+    model, tft_layer, serving_feature_spec, jit_compile=False
+):
+  """Returns a serving signature that accepts `tensorflow.Example`.
 
-def _get_tf_examples_serving_signature(model, tf_transform_output):
-  """Returns a serving signature that accepts `tensorflow.Example`."""
-  model.tft_layer_inference = tf_transform_output.transform_features_layer()
+  Args:
+    model: The trained Keras model.
+    tft_layer: The TFT layer that transforms raw features.
+    serving_feature_spec: The raw feature spec without the label.
+    jit_compile: Whether to compile the model forward pass with XLA. Parsing
+      and the TFT layer rely on string ops that XLA cannot compile, so they
+      always run outside of the XLA cluster. Note that TensorFlow Serving
+      only runs XLA:CPU models with `--xla_cpu_compilation_enabled`.
+  """
+  model_fn = tf.function(model, jit_compile=True) if jit_compile else model
 
   @tf.function(
       input_signature=[
@@ -107,21 +161,20 @@ def _get_tf_examples_serving_signature(model, tf_transform_output):
       ]
   )
   def serve_tf_examples_fn(serialized_tf_example):
-    raw_feature_spec = tf_transform_output.raw_feature_spec()
-    raw_feature_spec.pop(_LABEL_KEY)
-    raw_features = tf.io.parse_example(serialized_tf_example, raw_feature_spec)
-    transformed_features = model.tft_layer_inference(raw_features)
+    raw_features = tf.io.parse_example(
+        serialized_tf_example, serving_feature_spec
+    )
+    transformed_features = tft_layer(raw_features)
     logging.info('serve_transformed_features = %s', transformed_features)
 
-    outputs = model(transformed_features)
+    outputs = model_fn(transformed_features)
     return {'outputs': outputs}
 
   return serve_tf_examples_fn
 
 
-def _get_transform_features_signature(model, tf_transform_output):
+def _get_transform_features_signature(tft_layer, raw_feature_spec):
   """Returns a serving signature that accepts `tensorflow.Example`."""
-  model.tft_layer_eval = tf_transform_output.transform_features_layer()
 
   @tf.function(
       input_signature=[
@@ -129,9 +182,8 @@ def _get_transform_features_signature(model, tf_transform_output):
       ]
   )
   def transform_features_fn(serialized_tf_example):
-    raw_feature_spec = tf_transform_output.raw_feature_spec()
     raw_features = tf.io.parse_example(serialized_tf_example, raw_feature_spec)
-    transformed_features = model.tft_layer_eval(raw_features)
+    transformed_features = tft_layer(raw_features)
     logging.info('eval_transformed_features = %s', transformed_features)
     return transformed_features
 
@@ -161,7 +213,7 @@ def _input_fn(
   return data_accessor.tf_dataset_factory(
       file_pattern,
       dataset_options.TensorFlowDatasetOptions(
-          batch_size=batch_size, label_key=_transformed_name(_LABEL_KEY)
+          batch_size=batch_size, label_key=_LABEL_XF
       ),
       tf_transform_output.transformed_metadata.schema,
   ).repeat()
@@ -184,19 +236,19 @@ def _build_keras_model(
   # Keras needs the feature definitions at compile time.
   deep_input = {
       colname: tf.keras.layers.Input(name=colname, shape=(1,), dtype=tf.float32)
-      for colname in _transformed_names(_DENSE_FLOAT_FEATURE_KEYS)
+      for colname in _DENSE_FLOAT_XF
   }
   wide_vocab_input = {
       colname: tf.keras.layers.Input(name=colname, shape=(1,), dtype='int32')
-      for colname in _transformed_names(_VOCAB_FEATURE_KEYS)
+      for colname in _VOCAB_XF
   }
   wide_bucket_input = {
       colname: tf.keras.layers.Input(name=colname, shape=(1,), dtype='int32')
-      for colname in _transformed_names(_BUCKET_FEATURE_KEYS)
+      for colname in _BUCKET_XF
   }
   wide_categorical_input = {
       colname: tf.keras.layers.Input(name=colname, shape=(1,), dtype='int32')
-      for colname in _transformed_names(_CATEGORICAL_FEATURE_KEYS)
+      for colname in _CATEGORICAL_XF
   }
   input_layers = {
       **deep_input,
@@ -211,29 +263,34 @@ def _build_keras_model(
   for numnodes in (hidden_units or [100, 70, 50, 25]):
     deep = tf.keras.layers.Dense(numnodes)(deep)
 
-  wide_layers = []
-  for key in _transformed_names(_VOCAB_FEATURE_KEYS):
-    wide_layers.append(
-        tf.keras.layers.CategoryEncoding(num_tokens=_VOCAB_SIZE + _OOV_SIZE)(
-            input_layers[key]
-        )
-    )
-  for key in _transformed_names(_BUCKET_FEATURE_KEYS):
-    wide_layers.append(
-        tf.keras.layers.CategoryEncoding(num_tokens=_FEATURE_BUCKET_COUNT)(
-            input_layers[key]
-        )
-    )
-  for key, num_tokens in zip(
-      _transformed_names(_CATEGORICAL_FEATURE_KEYS),
-      _MAX_CATEGORICAL_FEATURE_VALUES,
-  ):
-    wide_layers.append(
-        tf.keras.layers.CategoryEncoding(num_tokens=num_tokens)(
-            input_layers[key]
-        )
-    )
-  wide = tf.keras.layers.concatenate(wide_layers)
+  wide_num_tokens = {
+      **{key: _VOCAB_SIZE + _OOV_SIZE for key in _VOCAB_XF},
+      **{key: _FEATURE_BUCKET_COUNT for key in _BUCKET_XF},
+      **dict(zip(_CATEGORICAL_XF, _MAX_CATEGORICAL_FEATURE_VALUES)),
+  }
+  # Shift each wide feature into its own token range, so that a single
+  # CategoryEncoding produces the concatenation of the per-feature encodings.
+  wide_offsets = [0, *itertools.accumulate(wide_num_tokens.values())][:-1]
+  wide = tf.keras.layers.concatenate(
+      [input_layers[key] for key in wide_num_tokens]
+  )
+
+  def _offset_wide_tokens(x):
+    # Check each column against its own token count, as the per-feature
+    # CategoryEncoding layers did, so that an out-of-range value fails instead
+    # of setting a bit in the next feature's range.
+    with tf.control_dependencies([
+        tf.debugging.assert_non_negative(x),
+        tf.debugging.assert_less(
+            x, tf.constant(list(wide_num_tokens.values()), dtype=x.dtype)
+        ),
+    ]):
+      return x + tf.constant(wide_offsets, dtype=x.dtype)
+
+  wide = tf.keras.layers.Lambda(_offset_wide_tokens)(wide)
+  wide = tf.keras.layers.CategoryEncoding(
+      num_tokens=sum(wide_num_tokens.values())
+  )(wide)
 
   output = tf.keras.layers.Dense(1, activation='sigmoid')(
       tf.keras.layers.concatenate([deep, wide])
@@ -273,39 +330,43 @@ def preprocessing_fn(inputs):
   Returns:
     Map from string feature key to transformed feature operations.
   """
+  # If sparse make it dense, setting nan's to 0 or ''. Each group of features
+  # is filled in separately, so that features that do not feed an analyzer
+  # are not pulled into the analysis pass.
   outputs = {}
-  for key in _DENSE_FLOAT_FEATURE_KEYS:
-    # If sparse make it dense, setting nan's to 0 or '', and apply zscore.
-    outputs[_transformed_name(key)] = tft.scale_to_z_score(
-        _fill_in_missing(inputs[key])
-    )
+  dense_float_inputs = _fill_in_missing(inputs, _DENSE_FLOAT_FEATURE_KEYS)
+  for key, xf_key in zip(_DENSE_FLOAT_FEATURE_KEYS, _DENSE_FLOAT_XF):
+    # Apply zscore.
+    outputs[xf_key] = tft.scale_to_z_score(dense_float_inputs[key])
 
-  for key in _VOCAB_FEATURE_KEYS:
+  vocab_inputs = _fill_in_missing(inputs, _VOCAB_FEATURE_KEYS)
+  for key, xf_key in zip(_VOCAB_FEATURE_KEYS, _VOCAB_XF):
     # Build a vocabulary for this feature.
-    outputs[_transformed_name(key)] = tft.compute_and_apply_vocabulary(
-        _fill_in_missing(inputs[key]),
+    outputs[xf_key] = tft.compute_and_apply_vocabulary(
+        vocab_inputs[key],
         top_k=_VOCAB_SIZE,
         num_oov_buckets=_OOV_SIZE,
     )
 
-  for key in _BUCKET_FEATURE_KEYS:
-    outputs[_transformed_name(key)] = tft.bucketize(
-        _fill_in_missing(inputs[key]), _FEATURE_BUCKET_COUNT
-    )
+  bucket_inputs = _fill_in_missing(inputs, _BUCKET_FEATURE_KEYS)
+  for key, xf_key in zip(_BUCKET_FEATURE_KEYS, _BUCKET_XF):
+    outputs[xf_key] = tft.bucketize(bucket_inputs[key], _FEATURE_BUCKET_COUNT)
 
-  for key in _CATEGORICAL_FEATURE_KEYS:
-    outputs[_transformed_name(key)] = _fill_in_missing(inputs[key])
+  categorical_inputs = _fill_in_missing(inputs, _CATEGORICAL_FEATURE_KEYS)
+  for key, xf_key in zip(_CATEGORICAL_FEATURE_KEYS, _CATEGORICAL_XF):
+    outputs[xf_key] = categorical_inputs[key]
 
   # Was this passenger a big tipper?
-  taxi_fare = _fill_in_missing(inputs[_FARE_KEY])
-  tips = _fill_in_missing(inputs[_LABEL_KEY])
-  outputs[_transformed_name(_LABEL_KEY)] = tf.where(
-      tf.math.is_nan(taxi_fare),
-      tf.cast(tf.zeros_like(taxi_fare), tf.int64),
-      # Test if the tip was > 20% of the fare.
-      tf.cast(
-          tf.greater(tips, tf.multiply(taxi_fare, tf.constant(0.2))), tf.int64
+  label_inputs = _fill_in_missing(inputs, [_FARE_KEY, _LABEL_KEY])
+  taxi_fare = label_inputs[_FARE_KEY]
+  tips = label_inputs[_LABEL_KEY]
+  # Test if the tip was > 20% of the fare; a missing fare is never a big tip.
+  outputs[_LABEL_XF] = tf.cast(
+      tf.math.logical_and(
+          tf.math.logical_not(tf.math.is_nan(taxi_fare)),
+          tips > 0.2 * taxi_fare,
       ),
+      tf.int64,
   )
 
   return outputs
@@ -332,8 +393,13 @@ def run_fn(fn_args: fn_args_utils.FnArgs):
       fn_args.eval_files, fn_args.data_accessor, tf_transform_output, 40
   )
 
-  mirrored_strategy = tf.distribute.MirroredStrategy()
-  with mirrored_strategy.scope():
+  # MirroredStrategy only pays off with several GPUs; otherwise use the
+  # default strategy and skip the collective ops setup.
+  if len(tf.config.list_physical_devices('GPU')) > 1:
+    strategy = tf.distribute.MirroredStrategy()
+  else:
+    strategy = tf.distribute.get_strategy()
+  with strategy.scope():
     model = _build_keras_model(
         # Construct layers sizes with exponetial decay
         hidden_units=[
@@ -355,12 +421,26 @@ def run_fn(fn_args: fn_args_utils.FnArgs):
       callbacks=[tensorboard_callback],
   )
 
+  # Both signatures share one TFT layer, which is tracked by the model so that
+  # its assets are exported with the SavedModel.
+  tft_layer = tf_transform_output.transform_features_layer()
+  model.tft_layer_inference = model.tft_layer_eval = tft_layer
+  raw_feature_spec = tf_transform_output.raw_feature_spec()
+  # The label is not available at serving time.
+  serving_feature_spec = {
+      key: spec for key, spec in raw_feature_spec.items() if key != _LABEL_KEY
+  }
   signatures = {
       'serving_default': _get_tf_examples_serving_signature(
-          model, tf_transform_output
+          model,
+          tft_layer,
+          serving_feature_spec,
+          jit_compile=(fn_args.custom_config or {}).get(
+              'jit_compile_serving', False
+          ),
       ),
       'transform_features': _get_transform_features_signature(
-          model, tf_transform_output
+          tft_layer, raw_feature_spec
       ),
   }
   tf.saved_model.save(model, fn_args.serving_model_dir, signatures=signatures)
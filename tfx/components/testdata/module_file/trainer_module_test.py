@@ -0,0 +1,82 @@
+# Copyright 2026 Google LLC. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for tfx.components.testdata.module_file.trainer_module."""
+
+import os
+
+import tensorflow as tf
+import tensorflow_transform as tft
+from tensorflow_transform.tf_metadata import schema_utils
+from tfx.components.testdata.module_file import trainer_module
+from tfx.utils import io_utils
+
+from tensorflow_metadata.proto.v0 import schema_pb2
+
+
+class TrainerModuleTest(tf.test.TestCase):
+
+  def testFillInMissing(self):
+    inputs = {
+        'float_a': tf.SparseTensor([[0, 0], [2, 0]], [1.0, 2.0], [3, 1]),
+        'float_b': tf.SparseTensor([[1, 0]], [3.0], [3, 1]),
+        'string': tf.SparseTensor([[0, 0]], [b'x'], [3, 1]),
+        'dense': tf.constant([[4], [5], [6]]),
+    }
+    outputs = trainer_module._fill_in_missing(inputs, list(inputs))
+
+    self.assertAllEqual([[1.0], [0.0], [2.0]], outputs['float_a'])
+    self.assertAllEqual([[0.0], [3.0], [0.0]], outputs['float_b'])
+    self.assertAllEqual([[b'x'], [b''], [b'']], outputs['string'])
+    self.assertIs(inputs['dense'], outputs['dense'])
+
+  def testFillInMissingKeepsStaticShape(self):
+    keys = ['float_a', 'float_b', 'int', 'string']
+
+    @tf.function(
+        input_signature=[{
+            'float_a': tf.SparseTensorSpec([None, None], tf.float32),
+            'float_b': tf.SparseTensorSpec([None, None], tf.float32),
+            'int': tf.SparseTensorSpec([None, None], tf.int64),
+            'string': tf.SparseTensorSpec([None, None], tf.string),
+        }]
+    )
+    def fill_in_missing(inputs):
+      outputs = trainer_module._fill_in_missing(inputs, keys)
+      # TFT needs every dimension but the batch one to be known.
+      for key in keys:
+        self.assertEqual([None, 1], outputs[key].shape.as_list(), key)
+      return outputs
+
+    fill_in_missing.get_concrete_function()
+
+  def testPreprocessingFnAnalyzeInputColumns(self):
+    schema = io_utils.parse_pbtxt_file(
+        os.path.join(
+            os.path.dirname(os.path.dirname(__file__)),
+            'schema_gen',
+            'schema.pbtxt',
+        ),
+        schema_pb2.Schema(),
+    )
+    feature_spec = schema_utils.schema_as_feature_spec(schema).feature_spec
+    # Only the features that feed an analyzer should be read by the analysis
+    # pass, even though missing values are filled in for several at once.
+    self.assertCountEqual(
+        trainer_module._DENSE_FLOAT_FEATURE_KEYS
+        + trainer_module._VOCAB_FEATURE_KEYS
+        + trainer_module._BUCKET_FEATURE_KEYS,
+        tft.get_analyze_input_columns(
+            trainer_module.preprocessing_fn, feature_spec
+        ),
+    )
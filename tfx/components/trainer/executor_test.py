@@ -25,6 +25,7 @@ from tfx.types import artifact_utils
 from tfx.types import standard_artifacts
 from tfx.types import standard_component_specs
 from tfx.utils import io_utils
+from tfx.utils import json_utils
 from tfx.utils import path_utils
 from tfx.utils import proto_utils
 
@@ -115,6 +116,25 @@ class ExecutorTest(tf.test.TestCase):
     self._verify_model_exports()
     self._verify_model_run_exports()
 
+  def testDoWithJitCompiledServing(self):
+    self._exec_properties[
+        standard_component_specs.MODULE_FILE_KEY] = self._module_file
+    self._exec_properties[
+        standard_component_specs.CUSTOM_CONFIG_KEY] = json_utils.dumps(
+            {'jit_compile_serving': True})
+    self._do(self._executor)
+    self._verify_model_exports()
+
+    # The exported serving signature runs the XLA-compiled forward pass.
+    model = tf.saved_model.load(
+        path_utils.serving_model_path(self._model_exports.uri))
+    serialized_examples = next(iter(tf.data.TFRecordDataset(
+        fileio.glob(os.path.join(self._source_data_dir,
+                                 'csv_example_gen/Split-eval/*')),
+        compression_type='GZIP').batch(10)))
+    outputs = model.signatures['serving_default'](serialized_examples)
+    self.assertEqual([10, 1], outputs['outputs'].shape.as_list())
+
   def testDoWithHyperParameters(self):
     hp_artifact = standard_artifacts.HyperParameters()
     hp_artifact.uri = os.path.join(self._output_data_dir, 'hyperparameters/')